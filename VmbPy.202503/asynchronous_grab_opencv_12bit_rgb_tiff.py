@@ -24,8 +24,10 @@ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
+import queue
 import sys
 import threading
+import time
 from typing import Optional
 
 import cv2
@@ -33,7 +35,13 @@ import cv2
 import numpy as np
 
 import tifffile
-import imageio.v3 as iio
+
+# Numba is optional, it fuses the 12 to 16 bit shift into one multi-threaded pass
+try:
+    from numba import njit, prange
+
+except ImportError:
+    njit = None
 
 
 
@@ -43,6 +51,25 @@ from vmbpy import *
 opencv_display_format = PixelFormat.Bgr8
 save_tiff_format = PixelFormat.BayerRG12
 
+# Demosaic on the GPU if OpenCV is built with CUDA support, otherwise fall back to the CPU
+use_cuda = cv2.cuda.getCudaEnabledDeviceCount() > 0
+
+# The CPU demosaic runs in horizontal strips sized to the per-core L2 cache. Each strip is
+# demosaiced with `strip_border` extra rows on both sides to provide the interpolation neighborhood.
+l2_cache_bytes = 1024 * 1024
+strip_border = 2
+
+# Image buffers shared between the frame callback and the TiffConsumer thread. With two buffers the
+# callback fills one while the consumer writes the other. If both are busy the frame is not saved.
+TIFF_BUFFER_COUNT = 2
+
+# Save every n-th BayerRG12 frame as TIFF, the preview window shows every frame
+tiff_frame_stride = 1
+
+# Print per frame information. Off by default, printing with flush=True on every frame slows down
+# the frame callback.
+debug_output = False
+
 
 def print_preamble():
     print('///////////////////////////////////////////////////')
@@ -110,7 +137,8 @@ def setup_camera(cam: Camera):
             stream = cam.get_streams()[0]
             stream.GVSPAdjustPacketSize.run()
             while not stream.GVSPAdjustPacketSize.is_done():
-                pass
+                # Poll without spinning, leaves the CPU and the GIL to the SDK threads
+                time.sleep(0.0005)
 
         except (AttributeError, VmbFeatureError):
             pass
@@ -143,9 +171,149 @@ def setup_pixel_format(cam: Camera):
         abort('Camera does not support an OpenCV compatible format. Abort.')
 
 
+def demosaic_strips(bayer_image_16bit: np.ndarray, rgb_tile: np.ndarray, strip_rows: int):
+    height = bayer_image_16bit.shape[0]
+
+    for y in range(0, height, strip_rows):
+        top = max(y - strip_border, 0)
+        bottom = min(y + strip_rows + strip_border, height)
+        rgb = rgb_tile[:bottom - top]
+
+        # tifffile writes the channels as they are, COLOR_BAYER_RG2BGR_EA yields R, G, B order for BayerRG
+        cv2.cvtColor(bayer_image_16bit[top:bottom], cv2.COLOR_BAYER_RG2BGR_EA, dst=rgb)
+        yield rgb[y - top:y - top + min(strip_rows, height - y)]
+
+
+if njit is not None:
+    # nogil lets the TiffConsumer thread write while a frame is shifted
+    @njit(parallel=True, nogil=True, cache=True)
+    def shift12_numba(src: np.ndarray, dst: np.ndarray):
+        for i in prange(src.shape[0]):
+            for j in range(src.shape[1]):
+                dst[i, j] = src[i, j] << 4
+
+
+def shift12(bayer_image_16bit: np.ndarray, shifted: np.ndarray) -> np.ndarray:
+    # Tiff format is very strange, lower 4 bits must be zeros for 12-bit images.
+    # Writes into `shifted`, the input may be the frame buffer that is requeued afterwards.
+    if njit is None:
+        return np.left_shift(bayer_image_16bit, 4, out=shifted)
+
+    shift12_numba(bayer_image_16bit, shifted)
+    return shifted
+
+
+class TiffConsumer(threading.Thread):
+    def __init__(self, tiff_queue: queue.Queue, free_queue: queue.Queue):
+        threading.Thread.__init__(self)
+
+        self.tiff_queue = tiff_queue
+        self.free_queue = free_queue
+
+        # Strip buffer for the CPU demosaic, allocated on the first image and reused afterwards
+        self.rgb_tile = None
+        self.strip_rows = 0
+
+    def setup_strips(self, height: int, width: int):
+        # Bayer input (2 bytes) and RGB output (6 bytes) of one strip should fit into L2.
+        # Keep the strip height even so every strip starts on the same Bayer phase.
+        self.strip_rows = min(max(64, l2_cache_bytes // (width * 8)), height) & ~1
+        self.rgb_tile = np.empty((self.strip_rows + 2 * strip_border, width, 3), dtype=np.uint16)
+
+    def run(self):
+        while True:
+            item = self.tiff_queue.get()
+
+            # None is queued after streaming stopped
+            if item is None:
+                break
+
+            output_tiff_path, image = item
+
+            try:
+                if image.ndim == 3:
+                    # RGB image, already demosaiced on the GPU
+                    # 直接保存16位RGB图像为TIFF, uncompressed
+                    tifffile.imwrite(output_tiff_path, image, bigtiff=False, photometric='rgb',
+                                     planarconfig='contig', compression=None)
+
+                else:
+                    # 3. 去马赛克 (Demosaicing)
+                    # 对于BayerRG12，对应的OpenCV去马赛克模式是 COLOR_BayerBG2RGB
+                    # 这是因为OpenCV中的Bayer模式命名与实际的拜耳模式可能存在差异。
+                    # BayerRG 通常对应 OpenCV 的 COLOR_BayerGR2RGB。
+                    # 但对于工业相机，BayerRG12的"RG"通常指的是第一行第一个像素是R，
+                    # 第二个是G，然后第二行第一个是G，第二个是B。
+                    # 实际使用中，你需要根据你的相机文档或实际测试来确定正确的Bayer模式。
+                    # Demosaic and write the TIFF strip by strip, so the 16-bit RGB plane is never
+                    # written out to memory as a whole and read back again by the encoder.
+                    height, width = image.shape
+                    if self.rgb_tile is None or self.rgb_tile.shape[1] != width:
+                        self.setup_strips(height, width)
+
+                    with tifffile.TiffWriter(output_tiff_path, bigtiff=False) as tif:
+                        tif.write(demosaic_strips(image, self.rgb_tile, self.strip_rows),
+                                  shape=(height, width, 3), dtype=np.uint16, photometric='rgb',
+                                  rowsperstrip=self.strip_rows, compression=None)
+
+            except OSError as e:
+                # Report the failed file and go on, one bad write must not stop all later ones
+                print('Failed to write {}: {}'.format(output_tiff_path, e), flush=True)
+
+            else:
+                if debug_output:
+                    print(f"成功将BayerRG12数据转换为RGB TIFF并保存到: {output_tiff_path}")
+
+            finally:
+                # Hand the buffer back to the frame callback, also if the write failed
+                self.free_queue.put(image)
+
+
 class Handler:
-    def __init__(self):
+    def __init__(self, tiff_queue: queue.Queue, free_queue: queue.Queue):
         self.shutdown_event = threading.Event()
+        self.tiff_queue = tiff_queue
+        self.free_queue = free_queue
+
+        if use_cuda:
+            # Device buffers and stream are reused for every frame, only the final images are downloaded
+            self.d_bayer = cv2.cuda_GpuMat()
+            self.d_rgb = cv2.cuda_GpuMat()
+            self.d_preview = cv2.cuda_GpuMat()
+            self.d_preview_bgr = cv2.cuda_GpuMat()
+            self.cuda_stream = cv2.cuda_Stream()
+
+        # (height, width) of the BayerRG12 frames, set by check_frame on the first frame
+        self.frame_size = None
+        self.frame_count = 0
+        # Frames which were due for saving but found no free TIFF buffer
+        self.skipped_tiffs = 0
+
+        # 8-bit preview buffers, allocated by check_frame and reused for every frame
+        self.preview_mosaic = None
+        self.preview_bgr = None
+
+    def check_frame(self, frame: Frame):
+        height = frame.get_height()
+        width = frame.get_width()
+        bayer_raw_data = np.frombuffer(frame.get_buffer(), dtype=np.uint16)
+
+        # 检查数据大小是否匹配, BayerRG12, use 16 bit to contain 12 bit pixel value
+        if frame.get_buffer_size() != width * height * 2:
+            raise ValueError(f"原始数据大小与指定的宽度和高度不匹配。期望 {width * height * 2}，实际 {frame.get_buffer_size()}")
+
+        # 16 bit raw data array's size is matched with W * H
+        if bayer_raw_data.size != width * height:
+            raise ValueError(f"原始数据大小与指定的宽度和高度不匹配。期望 {width * height}，实际 {bayer_raw_data.size}")
+
+        self.frame_size = (height, width)
+        self.preview_mosaic = np.empty((height, width), dtype=np.uint8)
+        self.preview_bgr = np.empty((height, width, 3), dtype=np.uint8)
+
+        # The consumer gets RGB images from the CUDA path and shifted Bayer images from the CPU path
+        tiff_shape = (height, width, 3) if use_cuda else (height, width)
+        for _ in range(TIFF_BUFFER_COUNT):
+            self.free_queue.put(np.empty(tiff_shape, dtype=np.uint16))
 
     def __call__(self, cam: Camera, stream: Stream, frame: Frame):
         ENTER_KEY_CODE = 13
@@ -156,75 +324,100 @@ class Handler:
             return
 
         elif frame.get_status() == FrameStatus.Complete:
-            print('{} acquired {} in {}'.format(cam, frame, frame.get_pixel_format()), flush=True)
-            # Convert frame if it is not already the correct format
-            if frame.get_pixel_format() == opencv_display_format:
-                display = frame
-            else:
-                # This creates a copy of the frame. The original `frame` object can be requeued
-                # safely while `display` is used
-                # display in opencv_display_format = PixelFormat.Bgr8 to show 
-                display = frame.convert_pixel_format(opencv_display_format)
+            if debug_output:
+                print('{} acquired {} in {}'.format(cam, frame, frame.get_pixel_format()), flush=True)
 
+            if frame.get_pixel_format() == save_tiff_format:
                 # BayerRG12 to 12 bit TIFF
-                height = frame.get_height()
-                width = frame.get_width()
-                #bayer_raw_data = frame.get_buffer()
-                bayer_raw_data = np.frombuffer(frame.get_buffer(), dtype=np.uint16)
-
-                # 检查数据大小是否匹配, BayerRG12, use 16 bit to contain 12 bit pixel value
-                if frame.get_buffer_size() != width * height * 2:
-                    raise ValueError(f"原始数据大小与指定的宽度和高度不匹配。期望 {width * height * 2}，实际 {frame.get_buffer_size()}")
-
-                # 16 bit raw data array's size is matched with W * H
-                if bayer_raw_data.size != width * height:
-                    raise ValueError(f"原始数据大小与指定的宽度和高度不匹配。期望 {width * height}，实际 {bayer_raw_data.size}")
-                
+                # The frame layout does not change while streaming, it is checked on the first frame only
+                if self.frame_size is None:
+                    self.check_frame(frame)
+
                 # 将一维数据 reshape 成二维图像
-                bayer_image_16bit = bayer_raw_data.reshape((height, width))
-                pixel_value1 = bayer_image_16bit[0, 0]
-                pixel_value2 = bayer_image_16bit[100, 100]
-                pixel_value3 = bayer_image_16bit[200, 200]
-                print('BayerRG12 raw data origin: {}, {}, {}'.format(pixel_value1, pixel_value2, pixel_value3), flush=True)
-
-                #DONE: saved tiff seems very black, Use Ctrl+I inverse and see something ...
-                # Tiff format is very strange, lower 4 bits must be zeros for 12-bit images
-                bayer_image_16bit = (bayer_image_16bit << 4).astype(np.uint16)  # 或保持 np.uint16 看需求
-
-                pixel_value1 = bayer_image_16bit[0, 0]
-                pixel_value2 = bayer_image_16bit[100, 100]
-                pixel_value3 = bayer_image_16bit[200, 200]
-                print('BayerRG12 raw data tiff  : {}, {}, {}'.format(pixel_value1, pixel_value2, pixel_value3), flush=True)
-
-                # 3. 去马赛克 (Demosaicing)
-                # 对于BayerRG12，对应的OpenCV去马赛克模式是 COLOR_BayerBG2RGB
-                # 这是因为OpenCV中的Bayer模式命名与实际的拜耳模式可能存在差异。
-                # BayerRG 通常对应 OpenCV 的 COLOR_BayerGR2RGB。
-                # 但对于工业相机，BayerRG12的"RG"通常指的是第一行第一个像素是R，
-                # 第二个是G，然后第二行第一个是G，第二个是B。
-                # 实际使用中，你需要根据你的相机文档或实际测试来确定正确的Bayer模式。
-                rgb_image = cv2.cvtColor(bayer_image_16bit, cv2.COLOR_BAYER_RG2RGB_EA )
+                # A 2D uint16 view straight onto the frame buffer, no copy and no intermediate 1D array.
+                # The buffer is writable with AnnounceFrame, the data is only read here though.
+                bayer_image_16bit = np.ndarray(self.frame_size, dtype=np.uint16, buffer=frame.get_buffer())
 
+                if debug_output:
+                    pixel_value1 = bayer_image_16bit[0, 0]
+                    pixel_value2 = bayer_image_16bit[100, 100]
+                    pixel_value3 = bayer_image_16bit[200, 200]
+                    print('BayerRG12 raw data origin: {}, {}, {}'.format(pixel_value1, pixel_value2, pixel_value3), flush=True)
 
-                output_tiff_path = "output_" + str(frame.get_id()) + ".tiff"
+                # Every frame is previewed in 8 bit, only every `tiff_frame_stride`-th frame is
+                # converted to 16-bit RGB and saved.
+                save_tiff = self.frame_count % tiff_frame_stride == 0
+                self.frame_count += 1
 
-                # 直接保存16位RGB图像为TIFF, compressed
-                cv2.imwrite(output_tiff_path, rgb_image) 
+                if save_tiff:
+                    # Never block the frame callback, skip saving if the consumer still holds all buffers
+                    try:
+                        tiff_image = self.free_queue.get_nowait()
 
-                #TODO: tiffile / imageio.v3 not work well ！！！
-                # Save as TIFF without compression
-                #tifffile.imwrite(output_tiff_path, rgb_image, compression=None)
-                # Save as 16-bit TIFF with no compression
-                #iio.imwrite(output_tiff_path, rgb_image, extension=".tiff", compression="none")
+                    except queue.Empty:
+                        save_tiff = False
+                        self.skipped_tiffs += 1
 
-                print(f"成功将BayerRG12数据转换为RGB TIFF并保存到: {output_tiff_path}")
+                        if debug_output:
+                            print('TIFF buffers busy, frame {} not saved'.format(frame.get_id()), flush=True)
 
+                output_tiff_path = "output_" + str(frame.get_id()) + ".tiff"
 
+                # The TIFF is written on the TiffConsumer thread after `frame` has been requeued,
+                # so the image is copied into `tiff_image`, a buffer owned by the consumer until written.
+                if use_cuda:
+                    # Upload once and keep shift and demosaic on the device. The preview is scaled
+                    # and demosaiced in 8 bit on the device as well, so besides the upload only the
+                    # final images cross the bus. Nothing waits on the host until all downloads are queued.
+                    self.d_bayer.upload(bayer_image_16bit, self.cuda_stream)
+                    self.d_bayer.convertTo(cv2.CV_8U, 1 / 16, 0.0, self.cuda_stream, self.d_preview)
+                    cv2.cuda.demosaicing(self.d_preview, cv2.COLOR_BAYER_RG2RGB, dst=self.d_preview_bgr,
+                                         dcn=3, stream=self.cuda_stream)
+
+                    if save_tiff:
+                        # Lower 4 bits must be zeros for 12-bit images in TIFF, see below.
+                        # tifffile writes the channels as they are, COLOR_BayerRG2BGR_MHT yields R, G, B order.
+                        cv2.cuda.lshift(self.d_bayer, 4, dst=self.d_bayer, stream=self.cuda_stream)
+                        cv2.cuda.demosaicing(self.d_bayer, cv2.cuda.COLOR_BayerRG2BGR_MHT, dst=self.d_rgb,
+                                             dcn=3, stream=self.cuda_stream)
+                        self.d_rgb.download(self.cuda_stream, tiff_image)
+
+                    display_image = self.d_preview_bgr.download(self.cuda_stream, self.preview_bgr)
+                    self.cuda_stream.waitForCompletion()
+
+                else:
+                    # 12 bit to 8 bit, then a cheap bilinear demosaic for the preview window.
+                    # COLOR_BAYER_RG2RGB yields the B, G, R order cv2.imshow expects for BayerRG.
+                    cv2.convertScaleAbs(bayer_image_16bit, dst=self.preview_mosaic, alpha=1 / 16)
+                    display_image = cv2.cvtColor(self.preview_mosaic, cv2.COLOR_BAYER_RG2RGB, dst=self.preview_bgr)
+
+                    if save_tiff:
+                        #DONE: saved tiff seems very black, Use Ctrl+I inverse and see something ...
+                        # Tiff format is very strange, lower 4 bits must be zeros for 12-bit images
+                        # The shifted copy is demosaiced by the TiffConsumer thread
+                        shift12(bayer_image_16bit, tiff_image)
+
+                        if debug_output:
+                            pixel_value1 = tiff_image[0, 0]
+                            pixel_value2 = tiff_image[100, 100]
+                            pixel_value3 = tiff_image[200, 200]
+                            print('BayerRG12 raw data tiff  : {}, {}, {}'.format(pixel_value1, pixel_value2, pixel_value3), flush=True)
+
+                if save_tiff:
+                    # Cannot be full, there are never more images in flight than buffers
+                    self.tiff_queue.put_nowait((output_tiff_path, tiff_image))
 
+            # Convert frame if it is not already the correct format
+            elif frame.get_pixel_format() == opencv_display_format:
+                display_image = frame.as_opencv_image()
 
+            else:
+                # This creates a copy of the frame. The original `frame` object can be requeued
+                # safely while `display_image` is used
+                display_image = frame.convert_pixel_format(opencv_display_format).as_opencv_image()
 
             msg = 'Stream from \'{}\' in format {}. Press <Enter> to stop stream.'
-            cv2.imshow(msg.format(cam.get_name(), frame.get_pixel_format()), display.as_opencv_image())
+            cv2.imshow(msg.format(cam.get_name(), frame.get_pixel_format()), display_image)
 
         cam.queue_frame(frame)
 
@@ -242,16 +435,37 @@ def main():
             # set BayerRG12 format for color camera
             cam.set_pixel_format(save_tiff_format)
 
-            handler = Handler()
+            # One more slot for the None queued on shutdown
+            tiff_queue = queue.Queue(maxsize=TIFF_BUFFER_COUNT + 1)
+            free_queue = queue.Queue(maxsize=TIFF_BUFFER_COUNT)
+            tiff_consumer = TiffConsumer(tiff_queue, free_queue)
+            handler = Handler(tiff_queue, free_queue)
+
+            # Compile shift12_numba now, otherwise the first frame callback pays for it.
+            # Done before the consumer starts, a failure here must not leave it waiting for None.
+            if njit is not None:
+                shift12(np.zeros((2, 2), dtype=np.uint16), np.empty((2, 2), dtype=np.uint16))
+
+            tiff_consumer.start()
 
             try:
-                # Start Streaming with a custom a buffer of 10 Frames (defaults to 5)
-                cam.start_streaming(handler=handler, buffer_count=10)
+                # Start Streaming with a custom a buffer of 10 Frames (defaults to 5).
+                # AnnounceFrame is VmbPy's default, it is passed explicitly for clarity.
+                cam.start_streaming(handler=handler,
+                                    buffer_count=10,
+                                    allocation_mode=AllocationMode.AnnounceFrame)
                 handler.shutdown_event.wait()
 
             finally:
                 cam.stop_streaming()
 
+                # Let the writer finish the pending images
+                tiff_queue.put(None)
+                tiff_consumer.join()
+
+                if handler.skipped_tiffs:
+                    print('{} frames were not saved as TIFF, all TIFF buffers were still being written.'.format(handler.skipped_tiffs))
+
 
 if __name__ == '__main__':
     main()
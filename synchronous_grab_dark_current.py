@@ -107,7 +107,8 @@ def setup_camera(cam: Camera):
             cam.GVSPAdjustPacketSize.run()
 
             while not cam.GVSPAdjustPacketSize.is_done():
-                pass
+                # Poll without spinning, leaves the CPU and the GIL to the SDK threads
+                time.sleep(0.0005)
             
             
 
@@ -133,11 +134,10 @@ def main():
                 5000, 5500, 6000, 6500, 7000, 
                 7500, 8000, 8500, 9000, 9500, 9900
                 ]
-    a = np.array(expArray)/1000
-    print(a)
+    expSeconds = np.asarray(expArray, dtype=np.float64) / 1000.0
+    print(expSeconds)
     
     # Main part
-    expSeconds = a.tolist();
     x = expSeconds[25:]          # in second
     print(x)
 
@@ -166,6 +166,7 @@ def main():
             corrMode.set("Off");
             
             tempCam = cam.get_feature_by_name("DeviceTemperature")
+            feat = cam.get_feature_by_name('ExposureTime')
             
 
             # Acquire 10 frame with a custom timeout (default is 2000ms) per frame acquisition.
@@ -176,7 +177,6 @@ def main():
                 # Step index
                 i = i + 1
                 
-                feat = cam.get_feature_by_name('ExposureTime')
                 feat.set(exp * 1000.000) # in us
                 time.sleep(1);
 
@@ -189,12 +189,16 @@ def main():
                 
                 # Save as MONO12 raw data
                 img = frame.as_numpy_ndarray()
-                a = np.average(img)
+                # Integer accumulation, no float64 copy of every pixel
+                a = int(img.sum(dtype=np.uint64)) / img.size
                 expAvgVal.append(a)
             
                 # print('Got {}, exporsue:{:10.3f}us, average:{:8.2f}'.format(frame, feat.get(), a), flush=True)
-                print('Got Frame {:5d}, exporsue:{:10.0f}us, temp:{:6.3f}, average:{:8.2f}'.format(i, feat.get(), tempCam.get(), a), flush=True)
-                fw.write('{:5d},{:10.0f},{:8.3f},{:8.2f}\n'.format(i, feat.get(), tempCam.get(), a))
+                # Read each feature once per step, every get() is a call into the SDK
+                expTime = feat.get()
+                temp = tempCam.get()
+                print('Got Frame {:5d}, exporsue:{:10.0f}us, temp:{:6.3f}, average:{:8.2f}'.format(i, expTime, temp, a), flush=True)
+                fw.write('{:5d},{:10.0f},{:8.3f},{:8.2f}\n'.format(i, expTime, temp, a))
                
     fw.close()
             
@@ -25,6 +25,7 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import sys
+import time
 from typing import Optional
 from queue import Queue
 
@@ -37,6 +38,10 @@ from vmbpy import *
 # All frames will either be recorded in this format, or transformed to it before being displayed
 opencv_display_format = PixelFormat.Bgr8
 
+# Print per frame information. Off by default, printing with flush=True on every frame competes
+# with the display loop for the GIL.
+debug_output = False
+
 
 def print_preamble():
     print('///////////////////////////////////////////////////')
@@ -152,7 +157,8 @@ def setup_camera(cam: Camera):
             stream = cam.get_streams()[0]
             stream.GVSPAdjustPacketSize.run()
             while not stream.GVSPAdjustPacketSize.is_done():
-                pass
+                # Poll without spinning, leaves the CPU and the GIL to the SDK threads
+                time.sleep(0.0005)
 
         except (AttributeError, VmbFeatureError):
             # print("ERROR3:", VmbFeatureError)
@@ -203,7 +209,8 @@ class Handler:
 
     def __call__(self, cam: Camera, stream: Stream, frame: Frame):
         if frame.get_status() == FrameStatus.Complete:
-            print('{} acquired {}'.format(cam, frame), flush=True)
+            if debug_output:
+                print('{} acquired {}'.format(cam, frame), flush=True)
 
             # Convert frame if it is not already the correct format
             # if frame.get_pixel_format() == opencv_display_format:
@@ -240,8 +247,11 @@ def main():
             handler = Handler()
 
             try:
-                # Start Streaming with a custom a buffer of 10 Frames (defaults to 5)
-                cam.start_streaming(handler=handler, buffer_count=10)
+                # Start Streaming with a custom a buffer of 10 Frames (defaults to 5).
+                # AnnounceFrame is VmbPy's default, it is passed explicitly for clarity.
+                cam.start_streaming(handler=handler,
+                                    buffer_count=10,
+                                    allocation_mode=AllocationMode.AnnounceFrame)
 
                 msg = 'Stream from \'{}\'. Press <Enter> to stop stream.'
                 import cv2
@@ -254,21 +264,18 @@ def main():
 
                     frame = handler.get_image()
 
-                    if frame.get_pixel_format() == opencv_display_format:
-                        display = frame
-                    else:
-                        # This creates a copy of the frame. The original `frame` object can be requeued
-                        # safely while `display` is used
-                        display = frame.convert_pixel_format(opencv_display_format)
-
-                    img_opencv = frame.as_opencv_image()
-                    img_numpy = frame.as_numpy_ndarray()
+                    # Statistics and display both use the raw frame, no pixel format conversion.
+                    # as_opencv_image() is the same ndarray view as as_numpy_ndarray(), so it is taken once.
+                    img_numpy = frame.as_opencv_image()
 
-                    print("image   as array:", img_numpy.shape, img_numpy.dtype)
+                    if debug_output:
+                        print("image   as array:", img_numpy.shape, img_numpy.dtype)
 
-                    mean_value = np.mean(img_numpy)
-                    total_sum = np.sum(img_numpy)
-                    print("image frame info:", frame.get_buffer_size(), ", mean:",  mean_value ,", sum:", total_sum)
+                    # One pass over the frame, the mean follows from the sum
+                    total_sum = int(img_numpy.sum(dtype=np.uint64))
+                    mean_value = total_sum / img_numpy.size
+                    if debug_output:
+                        print("image frame info:", frame.get_buffer_size(), ", mean:",  mean_value ,", sum:", total_sum)
                     # print(img_numpy)
 
                     # Write the text to the file
@@ -276,7 +283,7 @@ def main():
 
 
 
-                    cv2.imshow(msg.format(cam.get_name()), img_opencv)
+                    cv2.imshow(msg.format(cam.get_name()), img_numpy)
 
             finally:
                 file.close()